@@ -2,7 +2,7 @@ from datetime import date, datetime, timedelta
 from github import GitHubRepo
 import sqlite3
 
-CURRENT_VERSION = 2
+CURRENT_VERSION = 4
 
 
 class Database():
@@ -17,7 +17,9 @@ class Database():
         print(f"Connecting to DB {db_file} ...")
 
         try:
-            self._connection = sqlite3.connect(db_file)
+            # writes may happen on the pipeline's writer thread
+            self._connection = sqlite3.connect(
+                db_file, check_same_thread=False)
             print("Connected to DB.")
             return True
 
@@ -25,6 +27,12 @@ class Database():
             print(e)
             return False
 
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
     def disconnect(self):
         if self._connection == None:
             return
@@ -33,12 +41,20 @@ class Database():
         self._connection.close()
 
     def update_tables(self):
+        self._enable_incremental_vacuum()
         version = self._get_version()
 
         if version == 1:
             self._update_table_repositories_to_v2()
 
         self._create_tables()
+
+        if version == 3:
+            self._update_table_repo_summary_to_v4()
+
+        if version < 3:
+            self._rebuild_summaries()
+
         self._update_about()
 
     def _update_about(self):
@@ -66,9 +82,23 @@ class Database():
         self._create_table_releases()
         self._create_table_assets()
         self._create_table_downloads()
+        self._create_table_release_summary()
+        self._create_table_repo_summary()
+        self._create_table_fetch_journal()
 
         self._connection.commit()
 
+    def _enable_incremental_vacuum(self):
+        cursor = self._connection.execute("PRAGMA auto_vacuum;")
+
+        if cursor.fetchone()[0] == 2:
+            return
+
+        # changing auto_vacuum on an existing database requires one full VACUUM
+        print("Enabling incremental vacuum ...")
+        self._connection.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        self._connection.execute("VACUUM;")
+
     def _enable_foreign_keys(self):
         self._connection.execute("PRAGMA foreign_keys = ON;")
         self._connection.commit()
@@ -100,10 +130,14 @@ class Database():
 
         self._connection.commit()
 
-    def add_repositories(self, repos: list[GitHubRepo]):
+    def add_repositories(self, repos: list[GitHubRepo], commit: bool = True):
         self._connection.executemany(
             "INSERT OR IGNORE INTO repositories (name) VALUES (?);", [(str(repo), ) for repo in repos])
-        self._connection.commit()
+        self._connection.execute(
+            "INSERT OR IGNORE INTO repo_summary (repo_id) SELECT id FROM repositories;")
+
+        if commit:
+            self._connection.commit()
 
     def get_repo_id(self, repo: GitHubRepo) -> int | None:
         try:
@@ -134,7 +168,7 @@ class Database():
                 UNIQUE(timestamp, repo_id)
             );""")
 
-    def add_views(self, repo: GitHubRepo, data: dict):
+    def add_views(self, repo: GitHubRepo, data: dict, commit: bool = True):
         data["repoId"] = repo.db_id
         self._connection.execute("""
             INSERT INTO views (timestamp, repo_id, count, uniques)
@@ -143,14 +177,20 @@ class Database():
                 count = excluded.count,
                 uniques = excluded.uniques;
             """, data)
-        self._connection.commit()
+        self._update_repo_summary_views(repo, data["timestamp"], data["count"], data["uniques"])
+
+        if commit:
+            self._connection.commit()
 
-    def add_views_zero(self, repo: GitHubRepo, day: str):
+    def add_views_zero(self, repo: GitHubRepo, day: str, commit: bool = True):
         self._connection.execute("""
             INSERT OR IGNORE INTO views (timestamp, repo_id, count, uniques)
             VALUES(?, ?, 0, 0);
             """, [day, repo.db_id])
-        self._connection.commit()
+        self._update_repo_summary_views(repo, day, 0, 0)
+
+        if commit:
+            self._connection.commit()
 
     def get_views(self, repo: GitHubRepo) -> list[sqlite3.Row]:
         cursor = self._connection.cursor()
@@ -187,7 +227,7 @@ class Database():
             """, [repo.db_id])
         return cursor.fetchall()
 
-    def add_release(self, repo: GitHubRepo, release: dict, day: str):
+    def add_release(self, repo: GitHubRepo, release: dict, day: str, commit: bool = True):
         release["username"] = release["author"]["login"]
         release["repoId"] = repo.db_id
 
@@ -205,7 +245,49 @@ class Database():
             self._add_asset(repo, release, asset)
             self._add_download_data(repo, release, asset, day)
 
-        self._connection.commit()
+        self._update_release_summary(repo, release, day)
+
+        if commit:
+            self._connection.commit()
+
+    def get_release_creation_dates(self, repo: GitHubRepo) -> set[str]:
+        cursor = self._connection.execute("""
+            SELECT created_at
+            FROM releases
+            WHERE repo_id = ?;
+            """, [repo.db_id])
+        return {row[0] for row in cursor.fetchall()}
+
+    def add_download_counts(self, repo: GitHubRepo, release: dict, day: str, commit: bool = True) -> bool:
+        cursor = self._connection.execute("""
+            SELECT id
+            FROM releases
+            WHERE created_at = ? AND repo_id = ?
+            LIMIT 1;
+            """, [release["createdAt"], repo.db_id])
+        res = cursor.fetchone()
+
+        if res == None:
+            print(f"Release {release['createdAt']} of {repo} is not stored, skipping download counts.")
+            return False
+
+        counts = {asset["name"]: asset["downloadCount"]
+                  for asset in release["releaseAssets"]["nodes"]}
+
+        # compared per release so all assets keep sharing the same timestamps
+        if counts == self._get_newest_download_counts_by_name(res[0]):
+            return False
+
+        for asset in release["releaseAssets"]["nodes"]:
+            self._add_asset(repo, release, asset)
+            self._add_download_data(repo, release, asset, day)
+
+        self._update_release_summary(repo, release, day)
+
+        if commit:
+            self._connection.commit()
+
+        return True
 
     def _get_all_release_ids(self) -> list[int]:
         cursor = self._connection.execute("SELECT id FROM releases;")
@@ -301,6 +383,19 @@ class Database():
             """, [newest_timestamp, release_id])
         return cursor.fetchall()
 
+    def _get_newest_download_counts_by_name(self, release_id: int) -> dict[str, int]:
+        cursor = self._connection.execute("""
+            SELECT r.name, l.count
+            FROM downloads l
+            INNER JOIN assets r ON r.id = l.asset_id
+            WHERE r.release_id = ? AND l.timestamp = (
+                SELECT max(d.timestamp)
+                FROM downloads d
+                INNER JOIN assets a ON a.id = d.asset_id
+                WHERE a.release_id = ?);
+            """, [release_id, release_id])
+        return {name: count for name, count in cursor.fetchall()}
+
     def get_download_counts(self, asset: sqlite3.Row) -> list[sqlite3.Row]:
         cursor = self._connection.cursor()
         cursor.row_factory = sqlite3.Row
@@ -349,3 +444,262 @@ class Database():
                 obsolete_timestamps.append(data[i]["timestamp"])
 
         return obsolete_timestamps
+
+    def _create_table_release_summary(self):
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS release_summary (
+                release_id INTEGER PRIMARY KEY NOT NULL,
+                repo_id INTEGER NOT NULL,
+                downloads INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                FOREIGN KEY (release_id) REFERENCES releases (id),
+                FOREIGN KEY (repo_id) REFERENCES repositories (id)
+            );""")
+
+    def _create_table_repo_summary(self):
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS repo_summary (
+                repo_id INTEGER PRIMARY KEY NOT NULL,
+                releases INTEGER NOT NULL DEFAULT 0,
+                downloads INTEGER NOT NULL DEFAULT 0,
+                views_timestamp TEXT,
+                views_count INTEGER NOT NULL DEFAULT 0,
+                views_uniques INTEGER NOT NULL DEFAULT 0,
+                last_fetched TEXT,
+                latest_release_id INTEGER,
+                FOREIGN KEY (repo_id) REFERENCES repositories (id),
+                FOREIGN KEY (latest_release_id) REFERENCES releases (id)
+            );""")
+
+    def _update_table_repo_summary_to_v4(self):
+        print("Updating table 'repo_summary' ...")
+        self._connection.execute(
+            "ALTER TABLE repo_summary ADD COLUMN latest_release_id INTEGER REFERENCES releases (id);")
+        self._update_latest_releases()
+        self._connection.commit()
+
+    def _update_latest_releases(self):
+        self._connection.execute("""
+            UPDATE repo_summary SET latest_release_id = (
+                SELECT id
+                FROM releases
+                WHERE repo_id = repo_summary.repo_id
+                ORDER BY created_at DESC
+                LIMIT 1);
+            """)
+
+    def _update_release_summary(self, repo: GitHubRepo, release: dict, day: str):
+        downloads = sum(asset["downloadCount"]
+                        for asset in release["releaseAssets"]["nodes"])
+
+        release_id = self._connection.execute(
+            "SELECT id FROM releases WHERE created_at = ? AND repo_id = ?;",
+            [release["createdAt"], repo.db_id]).fetchone()[0]
+
+        self._connection.execute("""
+            UPDATE repo_summary SET latest_release_id = ?
+            WHERE repo_id = ? AND (latest_release_id IS NULL OR
+                ? > (SELECT created_at FROM releases WHERE id = repo_summary.latest_release_id));
+            """, [release_id, repo.db_id, release["createdAt"]])
+
+        previous = self._connection.execute(
+            "SELECT downloads, timestamp FROM release_summary WHERE release_id = ?;",
+            [release_id]).fetchone()
+
+        # older snapshots (e.g. from a backfill) must not replace newer totals
+        if previous != None and previous[1] > day:
+            return
+
+        self._connection.execute("""
+            REPLACE INTO release_summary (release_id, repo_id, downloads, timestamp)
+            VALUES (?, ?, ?, ?);
+            """, [release_id, repo.db_id, downloads, day])
+
+        if previous == None:
+            self._add_to_repo_summary(repo.db_id, 1, downloads)
+        else:
+            self._add_to_repo_summary(repo.db_id, 0, downloads - previous[0])
+
+    def _add_to_repo_summary(self, repo_id: int, releases: int, downloads: int):
+        self._connection.execute("""
+            INSERT INTO repo_summary (repo_id, releases, downloads)
+            VALUES (?, ?, ?)
+            ON CONFLICT (repo_id) DO UPDATE SET
+                releases = releases + excluded.releases,
+                downloads = downloads + excluded.downloads;
+            """, [repo_id, releases, downloads])
+
+    def _update_repo_summary_views(self, repo: GitHubRepo, timestamp: str, count: int, uniques: int):
+        self._connection.execute("""
+            INSERT INTO repo_summary (repo_id, views_timestamp, views_count, views_uniques)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (repo_id) DO UPDATE SET
+                views_timestamp = excluded.views_timestamp,
+                views_count = excluded.views_count,
+                views_uniques = excluded.views_uniques
+            WHERE repo_summary.views_timestamp IS NULL OR excluded.views_timestamp >= repo_summary.views_timestamp;
+            """, [repo.db_id, timestamp, count, uniques])
+
+    def set_last_fetched(self, repo: GitHubRepo, day: str, phases: list[str], commit: bool = True):
+        # only counts as fetched once every phase of the day has been journaled as done
+        self._connection.execute(f"""
+            UPDATE repo_summary SET last_fetched = ?
+            WHERE repo_id = ? AND (
+                SELECT count(*)
+                FROM fetch_journal
+                WHERE day = ? AND repo_id = ? AND status = 'done'
+                    AND phase IN ({",".join("?" * len(phases))})) = ?;
+            """, [str(datetime.now()), repo.db_id, day, repo.db_id, *phases, len(phases)])
+
+        if commit:
+            self._connection.commit()
+
+    def _create_table_fetch_journal(self):
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS fetch_journal (
+                day TEXT NOT NULL,
+                repo_id INTEGER NOT NULL,
+                phase TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (day, repo_id, phase),
+                FOREIGN KEY (repo_id) REFERENCES repositories (id)
+            );""")
+
+    def clear_journal(self, day: str):
+        self._connection.execute(
+            "DELETE FROM fetch_journal WHERE day < ?;", [day])
+        self._connection.commit()
+
+    def get_finished_phases(self, day: str) -> set[tuple[int, str]]:
+        cursor = self._connection.execute("""
+            SELECT repo_id, phase
+            FROM fetch_journal
+            WHERE day = ? AND status = 'done';
+            """, [day])
+        return set(cursor.fetchall())
+
+    def set_journal_status(self, repo: GitHubRepo, day: str, phase: str, status: str, commit: bool = True):
+        self._connection.execute("""
+            REPLACE INTO fetch_journal (day, repo_id, phase, status, updated_at)
+            VALUES (?, ?, ?, ?, ?);
+            """, [day, repo.db_id, phase, status, str(datetime.now())])
+
+        if commit:
+            self._connection.commit()
+
+    def _rebuild_summaries(self):
+        print("Building summary tables ...")
+        cursor = self._connection.cursor()
+
+        cursor.execute("DELETE FROM release_summary;")
+        cursor.execute("""
+            WITH newest AS (
+                SELECT a.release_id, max(d.timestamp) AS timestamp
+                FROM downloads d
+                INNER JOIN assets a ON a.id = d.asset_id
+                GROUP BY a.release_id
+            )
+            INSERT INTO release_summary (release_id, repo_id, downloads, timestamp)
+            SELECT r.id, r.repo_id, coalesce(sum(d.count), 0), coalesce(n.timestamp, '')
+            FROM releases r
+            LEFT JOIN newest n ON n.release_id = r.id
+            LEFT JOIN assets a ON a.release_id = r.id
+            LEFT JOIN downloads d ON d.asset_id = a.id AND d.timestamp = n.timestamp
+            GROUP BY r.id;
+            """)
+
+        cursor.execute("DELETE FROM repo_summary;")
+        cursor.execute("""
+            INSERT INTO repo_summary (repo_id, releases, downloads)
+            SELECT id,
+                (SELECT count(*) FROM release_summary WHERE repo_id = repositories.id),
+                (SELECT coalesce(sum(downloads), 0) FROM release_summary WHERE repo_id = repositories.id)
+            FROM repositories;
+            """)
+        cursor.execute("""
+            UPDATE repo_summary SET (views_timestamp, views_count, views_uniques) = (
+                SELECT timestamp, count, uniques
+                FROM views
+                WHERE repo_id = repo_summary.repo_id
+                ORDER BY timestamp DESC
+                LIMIT 1)
+            WHERE EXISTS (SELECT 1 FROM views WHERE repo_id = repo_summary.repo_id);
+            """)
+        self._update_latest_releases()
+
+        self._connection.commit()
+
+    def get_repo_summaries(self, repos: list[GitHubRepo]) -> list[sqlite3.Row]:
+        cursor = self._connection.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(f"""
+            SELECT r.name, s.releases, s.downloads, s.views_count, s.views_uniques, s.last_fetched,
+                rel.name AS latest_release
+            FROM repo_summary s
+            INNER JOIN repositories r ON r.id = s.repo_id
+            LEFT JOIN releases rel ON rel.id = s.latest_release_id
+            WHERE r.name IN ({",".join("?" * len(repos))})
+            ORDER BY s.downloads DESC, r.name ASC;
+            """, [str(repo) for repo in repos])
+        return cursor.fetchall()
+
+    def get_release_summaries(self, repo: GitHubRepo) -> list[sqlite3.Row]:
+        cursor = self._connection.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("""
+            SELECT r.id, r.name, r.created_at, r.author, coalesce(s.downloads, 0) AS downloads
+            FROM releases r
+            LEFT JOIN release_summary s ON s.release_id = r.id
+            WHERE r.repo_id = ?
+            ORDER BY r.created_at DESC;
+            """, [repo.db_id])
+        return cursor.fetchall()
+
+    def apply_retention(self, daily_days: int | None, weekly_days: int | None):
+        if daily_days == None:
+            return
+
+        print("Applying retention policy ...")
+
+        today = date.today()
+        weekly_cutoff = (today - timedelta(days=daily_days)).isoformat()
+        monthly_cutoff = (today - timedelta(days=weekly_days)
+                          ).isoformat() if weekly_days != None else ""
+
+        # views are weekly already and grow slowly, so they are kept as they are
+        self._thin_downloads(weekly_cutoff, monthly_cutoff)
+        self._connection.commit()
+
+    def _thin_downloads(self, weekly_cutoff: str, monthly_cutoff: str):
+        # keep the newest snapshot of every week / month per release, so that
+        # all assets of a release still share the same timestamps
+        cursor = self._connection.execute("""
+            DELETE FROM downloads WHERE id IN (
+                SELECT id FROM (
+                    SELECT d.id, d.timestamp, max(d.timestamp) OVER (
+                        PARTITION BY a.release_id,
+                            CASE WHEN d.timestamp < :monthly_cutoff
+                                THEN strftime('%Y-%m', d.timestamp)
+                                ELSE date(d.timestamp, 'weekday 0') END
+                        ) AS newest
+                    FROM downloads d
+                    INNER JOIN assets a ON a.id = d.asset_id
+                    WHERE d.timestamp < :weekly_cutoff)
+                WHERE timestamp < newest);
+            """, {"weekly_cutoff": weekly_cutoff, "monthly_cutoff": monthly_cutoff})
+        print(f"\tRemoved {cursor.rowcount} download rows.")
+
+    def incremental_vacuum(self, pages: int):
+        free_pages = self._connection.execute(
+            "PRAGMA freelist_count;").fetchone()[0]
+
+        if free_pages == 0:
+            return
+
+        print(f"Reclaiming up to {pages} of {free_pages} free pages ...")
+
+        # execute() only steps the pragma once (freeing a single page),
+        # executescript() runs it to completion
+        self._connection.executescript(
+            f"PRAGMA incremental_vacuum({int(pages)});")
@@ -1,5 +1,8 @@
 import requests
 import shortuuid
+from typing import Callable
+
+REQUEST_TIMEOUT = 60
 
 
 class GitHubRepo:
@@ -49,31 +52,47 @@ class GitHubConnector:
 
     def get_releases(self, repos: list[GitHubRepo]) -> dict:
         print("Fetching releases ...")
+        return self._fetch_releases(repos, self._make_releases_query)
+
+    def get_release_download_counts(self, repos: list[GitHubRepo]) -> dict:
+        print("Fetching release download counts ...")
+        return self._fetch_releases(repos, self._make_download_counts_query)
+
+    def get_newest_releases(self, counts: dict[GitHubRepo, int]) -> dict:
+        if len(counts) == 0:
+            return {}
 
+        print("Fetching new releases ...")
+        return self._fetch_releases(list(counts.keys()),
+                                    lambda repo, uuid: self._make_newest_releases_query(repo, uuid, counts[repo]))
+
+    def _fetch_releases(self, repos: list[GitHubRepo], make_query: Callable[[GitHubRepo, str], str]) -> dict:
         ids = {}
         subqueries = ""
 
         for repo in repos:
             uuid = self._short_uuid.uuid()
             ids[uuid] = repo
-            subqueries += self._make_releases_query(repo, uuid)
+            subqueries += make_query(repo, uuid)
 
         query = f"{{{subqueries}}}"
 
         url = "https://api.github.com/graphql"
         request = requests.post(
-            url, headers=self._make_headers(), json={"query": query})
+            url, headers=self._make_headers(), json={"query": query}, timeout=REQUEST_TIMEOUT)
 
         if not request.ok:
             print(request.status_code, request.text)
             return {}
 
-        res = request.json()["data"]
+        res = request.json().get("data") or {}
 
         releases = {}
 
+        # repositories that could not be queried are null and left out
         for uuid in res:
-            releases[ids[uuid]] = res[uuid]["releases"]["nodes"]
+            if res[uuid] != None:
+                releases[ids[uuid]] = res[uuid]["releases"]["nodes"]
 
         return releases
 
@@ -84,17 +103,30 @@ class GitHubConnector:
                     nodes{{name isPrerelease createdAt author{{login}}\
                     releaseAssets(last:99){{nodes{{name downloadCount}}}}}}}}}}"
 
-    def get_views(self, repo: GitHubRepo) -> list[dict]:
+    @staticmethod
+    def _make_download_counts_query(repo: GitHubRepo, uuid: str) -> str:
+        return f"{uuid}:repository(owner:\"{repo.owner}\",name:\"{repo.name}\"){{\
+                    releases(last:99,orderBy:{{direction:DESC,field:CREATED_AT}}){{\
+                    nodes{{createdAt releaseAssets(last:99){{nodes{{name downloadCount}}}}}}}}}}"
+
+    @staticmethod
+    def _make_newest_releases_query(repo: GitHubRepo, uuid: str, count: int) -> str:
+        return f"{uuid}:repository(owner:\"{repo.owner}\",name:\"{repo.name}\"){{\
+                    releases(first:{count},orderBy:{{direction:DESC,field:CREATED_AT}}){{\
+                    nodes{{name isPrerelease createdAt author{{login}}\
+                    releaseAssets(last:99){{nodes{{name downloadCount}}}}}}}}}}"
+
+    def get_views(self, repo: GitHubRepo) -> list[dict] | None:
         print("Fetching views for", repo, "...")
 
         url = f"https://api.github.com/repos/{repo}/traffic/views"
         params = {"per": "week"}
         request = requests.get(
-            url, params=params, headers=self._make_headers())
+            url, params=params, headers=self._make_headers(), timeout=REQUEST_TIMEOUT)
 
         if not request.ok:
             print(request.status_code, request.text)
-            return []
+            return None
 
         return request.json()["views"]
 
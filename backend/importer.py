@@ -0,0 +1,133 @@
+import json
+import time
+from pathlib import Path
+from typing import Iterator, TextIO
+from database import Database
+from github import GitHubRepo
+
+CHUNK_SIZE = 64 * 1024
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+# Each record is one snapshot of a repository as it was fetched on a given day:
+# {"repo": "owner/name", "timestamp": "2024-01-31", "releases": [...], "views": [...]}
+# "releases" uses the node layout of the GraphQL releases query and "views" the
+# layout of the traffic API, so exported data can be loaded like fetched data.
+# Files may contain a top level array of records, one or more concatenated records
+# or one record per line (NDJSON).
+
+
+def iter_json_records(file: TextIO) -> Iterator[dict]:
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    # characters and lines already dropped from the buffer, for error positions
+    offset = 0
+    lines = 0
+    line_delimited = False
+
+    while True:
+        # skip whitespace and the brackets / separators of a top level array
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,[]":
+            pos += 1
+
+        if pos == len(buffer):
+            if eof:
+                return
+
+            offset += len(buffer)
+            lines += buffer.count("\n")
+            buffer = file.read(CHUNK_SIZE)
+            pos = 0
+            eof = len(buffer) == 0
+            continue
+
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            # NDJSON records never span lines, so a complete line is malformed
+            if eof or (line_delimited and buffer.find("\n", pos) != -1):
+                raise ValueError(
+                    f"{e.msg}: line {lines + e.lineno} (char {offset + e.pos})") from e
+
+            if len(buffer) - pos >= MAX_RECORD_SIZE:
+                raise ValueError(
+                    f"Record at char {offset + pos} exceeds the maximum size of {MAX_RECORD_SIZE} characters.")
+
+            # grow geometrically, so large records are not re-parsed for every chunk
+            chunk = file.read(max(CHUNK_SIZE, len(buffer) - pos))
+            eof = len(chunk) == 0
+            offset += pos
+            lines += buffer.count("\n", 0, pos)
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        # a single line record followed by a line break marks the file as NDJSON
+        if not line_delimited and buffer.find("\n", pos, end) == -1:
+            rest = buffer[end:].lstrip(" \t\r")
+            line_delimited = rest.startswith("\n")
+
+        pos = end
+        yield record
+
+
+class SnapshotImporter:
+    def __init__(self, db: Database, batch_size: int) -> None:
+        self._db = db
+        self._batch_size = batch_size
+        self._repos = {}
+        self._rows = 0
+        self._pending_rows = 0
+        self._start = time.monotonic()
+
+    def import_file(self, path: Path):
+        print(f"Importing {path} ...")
+
+        with open(path, "r") as file:
+            for record in iter_json_records(file):
+                self._add_record(record)
+
+        if self._pending_rows > 0:
+            self._commit()
+
+    def _add_record(self, record: dict):
+        repo = self._get_repo(record["repo"])
+        day = record["timestamp"]
+
+        for release in record.get("releases", []):
+            self._db.add_release(repo, release, day, commit=False)
+            self._pending_rows += 1 + 2 * len(release["releaseAssets"]["nodes"])
+
+        for data in record.get("views", []):
+            self._db.add_views(repo, data, commit=False)
+            self._pending_rows += 1
+
+        if self._pending_rows >= self._batch_size:
+            self._commit()
+
+    def _get_repo(self, name: str) -> GitHubRepo:
+        name = name.lower()
+
+        if name not in self._repos:
+            repo = GitHubRepo(name)
+            self._db.add_repositories([repo], commit=False)
+            self._db.set_repo_ids([repo])
+            self._repos[name] = repo
+
+        return self._repos[name]
+
+    def _commit(self):
+        self._db.commit()
+        self._rows += self._pending_rows
+        self._pending_rows = 0
+        print(f"\t{self._rows} rows imported ({self.rows_per_second:.0f} rows/sec)")
+
+    @property
+    def rows(self) -> int:
+        return self._rows
+
+    @property
+    def rows_per_second(self) -> float:
+        elapsed = time.monotonic() - self._start
+        return self._rows / elapsed if elapsed > 0 else 0
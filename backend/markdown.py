@@ -1,6 +1,5 @@
 import datetime
 import inspect
-import uuid
 from github import GitHubRepo
 
 
@@ -28,6 +27,20 @@ def generate_hint(type: str, content: str) -> str:
     return f"{{{{< hint {type} >}}}}\n{content}\n{{{{< /hint >}}}}\n"
 
 
+def generate_table(headers: list[str], rows: list[list]) -> str:
+    res = f"| {' | '.join(headers)} |\n"
+    res += f"|{'|'.join(['---'] * len(headers))}|\n"
+
+    for row in rows:
+        res += f"| {' | '.join(map(_escape_table_cell, row))} |\n"
+
+    return res
+
+
+def _escape_table_cell(cell) -> str:
+    return str(cell).replace("|", "\\|")
+
+
 def generate_charts_header(release: dict) -> str:
     return inspect.cleandoc(f"""
         ### {release["name"]}
@@ -96,8 +109,8 @@ def _generate_line_chart_datasets(data: dict) -> str:
     return ",".join(sets)
 
 
-def generate_tabs(content: dict) -> str:
-    res = f"{{{{< tabs \"{uuid.uuid4()}\" >}}}}\n"
+def generate_tabs(id: str, content: dict) -> str:
+    res = f"{{{{< tabs \"{id}\" >}}}}\n"
 
     for key in content:
         res += _generate_tab(key, content[key])
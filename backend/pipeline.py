@@ -0,0 +1,69 @@
+import queue
+import threading
+from typing import Callable
+from database import Database
+
+QUEUE_SIZE = 64
+BATCH_SIZE = 32
+
+
+class WritePipeline:
+    def __init__(self, db: Database, queue_size: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE) -> None:
+        self._db = db
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="db-writer")
+        self._error = None
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._queue.put(None)
+        self._thread.join()
+
+        if self._error == None:
+            return
+
+        # keep both errors in the traceback if the body failed as well
+        if exc_value != None:
+            raise self._error from exc_value
+
+        raise self._error
+
+    def put(self, write: Callable[[Database], None]):
+        # blocks while the writer is behind, which throttles the fetchers
+        self._queue.put(write)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            done = batch[-1] == None
+            batch = [write for write in batch if write != None]
+
+            # keep draining after an error so producers never block on a full queue
+            if self._error == None and len(batch) > 0:
+                self._write(batch)
+
+            if done:
+                return
+
+    def _write(self, batch: list[Callable[[Database], None]]):
+        try:
+            for write in batch:
+                write(self._db)
+
+            self._db.commit()
+
+        except Exception as e:
+            print(e)
+            self._db.rollback()
+            self._error = e
@@ -1,23 +1,48 @@
 import argparse
 import inspect
 import os
+import requests
 import sqlite3
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
+from functools import partial
 from pathlib import Path
 import markdown as md
 from database import Database
 from github import GitHubRepo, GitHubConnector
+from importer import SnapshotImporter
+from pipeline import WritePipeline
 
 SQLITE_FILENAME = "stats.db"
 STATS_DIR = "../hugo/content/stats"
+IMPORT_BATCH_SIZE = 5000
+FETCH_WORKERS = 4
+VACUUM_PAGES = 1000
+RELEASES_PER_PAGE = 1
+
+LAYOUT_SINGLE = "single"
+LAYOUT_PAGED = "paged"
+
+PHASE_RELEASES = "releases"
+PHASE_VIEWS = "views"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+
+    return number
 
 
 def init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         usage="%(prog)s [option] ...",
-        description="Convert data from json files to the new db based approach."
+        description="Fetch release statistics from GitHub and generate the statistics pages."
     )
 
     parser.add_argument("--repos", action="store",
@@ -30,43 +55,114 @@ def init_argparse() -> argparse.ArgumentParser:
                         help="don't generate the web page")
     parser.add_argument("--generate-only",
                         action="store_true", help="don't fetch data")
+    parser.add_argument("--delta", action="store_true",
+                        help="only fetch full metadata for new releases and skip unchanged download counts")
+
+    parser.add_argument("--layout", action="store", choices=[LAYOUT_SINGLE, LAYOUT_PAGED], default=LAYOUT_SINGLE,
+                        help="generate one page per repository or an index page with separate release pages")
+    parser.add_argument("--releases-per-page", action="store", type=positive_int, default=RELEASES_PER_PAGE,
+                        help="number of releases per page in the paged layout")
+    parser.add_argument("--ignore-journal", action="store_true",
+                        help="fetch all repositories again, even if they were already fetched today")
+    parser.add_argument("--retention-daily", action="store", type=positive_int,
+                        help="keep daily download counts for this many days (default: keep everything)")
+    parser.add_argument("--retention-weekly", action="store", type=positive_int,
+                        help="keep weekly download counts for this many days, monthly ones afterwards")
+    parser.add_argument("--vacuum-pages", action="store", type=positive_int,
+                        help=f"maximum number of free pages to reclaim per run (default: {VACUUM_PAGES})")
+
+    subparsers = parser.add_subparsers(dest="command")
+    import_parser = subparsers.add_parser(
+        "import", help="import historical snapshots from JSON or NDJSON files")
+    import_parser.add_argument("files", action="store", nargs="+", type=Path,
+                               help="files to import")
+    import_parser.add_argument("--batch-size", action="store", type=positive_int, default=IMPORT_BATCH_SIZE,
+                               help="number of rows to write per transaction")
 
     return parser
 
 
-def delete_stats_dir():
-    shutil.rmtree(STATS_DIR)
-
-
 def create_stats_dir():
     Path(STATS_DIR).mkdir(parents=True, exist_ok=True)
 
 
-def create_owner_dir(repo: GitHubRepo) -> Path:
+def write_page(path: Path, content: str) -> Path:
+    # unchanged pages are left alone so that only updated pages get rebuilt
+    if not path.exists() or path.read_text() != content:
+        with open(path, "w") as file:
+            file.write(content)
+
+    return path
+
+
+def remove_stale_pages(pages: set[Path]):
+    for path in sorted(Path(STATS_DIR).rglob("*"), reverse=True):
+        if path.is_file() and path not in pages:
+            path.unlink()
+        elif path.is_dir() and not any(path.iterdir()):
+            path.rmdir()
+
+
+def create_owner_dir(repo: GitHubRepo) -> tuple[Path, Path]:
     owner_clean = repo.owner.replace("-", "_")
     dir_path = Path(STATS_DIR).joinpath(owner_clean)
     dir_path.mkdir(parents=True, exist_ok=True)
 
-    index_path = dir_path.joinpath("_index.md")
+    index_path = write_page(dir_path.joinpath("_index.md"),
+                            f"+++\ntitle = \"{repo.owner}\"\n+++\n")
 
-    with open(index_path, "w") as index_file:
-        index_file.write(f"+++\ntitle = \"{repo.owner}\"\n+++\n")
+    return dir_path, index_path
 
-    return dir_path
 
-
-def generate_all_pages(db: Database, repos: list[GitHubRepo]):
-    delete_stats_dir()
+def generate_all_pages(db: Database, repos: list[GitHubRepo], layout: str, releases_per_page: int):
     create_stats_dir()
 
+    pages = {generate_overview_page(db, repos)}
+
     for repo in repos:
-        generate_page(db, repo)
+        if layout == LAYOUT_PAGED:
+            pages.update(generate_paged_pages(db, repo, releases_per_page))
+        else:
+            pages.update(generate_page(db, repo))
+
+    remove_stale_pages(pages)
+
 
+def generate_overview_page(db: Database, repos: list[GitHubRepo]) -> Path:
+    print("Generating overview page ...")
 
-def generate_page(db: Database, repo: GitHubRepo):
+    summaries = db.get_repo_summaries(repos)
+
+    if len(summaries) == 0:
+        table = md.generate_hint("warning", "No repositories have been fetched yet.")
+    else:
+        table = md.generate_table(
+            ["#", "Repository", "Releases", "Latest Release", "Downloads", "Views (last week)", "Unique Visitors", "Last Fetched"],
+            [[i + 1, generate_repo_link(summary["name"]), summary["releases"], summary["latest_release"] or "-",
+              summary["downloads"], summary["views_count"], summary["views_uniques"],
+              summary["last_fetched"][:16] if summary["last_fetched"] else "-"]
+             for i, summary in enumerate(summaries)])
+
+    content = inspect.cleandoc(f"""
++++
+title = "Overview"
++++
+
+# Overview
+""")
+
+    return write_page(Path(STATS_DIR).joinpath("_index.md"), f"{content}\n\n{table}")
+
+
+def generate_repo_link(name: str) -> str:
+    repo = GitHubRepo(name)
+    return f"[{repo}]({repo.owner.replace('-', '_')}/{repo.name}/)"
+
+
+def generate_page(db: Database, repo: GitHubRepo) -> list[Path]:
     print(f"Generating page for {repo} ...")
 
-    owner_path = create_owner_dir(repo)
+    owner_path, owner_index_path = create_owner_dir(repo)
 
     content = inspect.cleandoc(f"""
 +++
@@ -80,11 +176,84 @@ title = \"{repo.name}\"
 {generate_view_chart(db, repo)}
 
 ## Releases
-{generate_release_charts(db, repo)}
+{generate_release_charts(db, db.get_releases(repo))}
+""")
+
+    return [owner_index_path, write_page(owner_path.joinpath(f"{repo.name}.md"), content)]
+
+
+def generate_paged_pages(db: Database, repo: GitHubRepo, releases_per_page: int) -> list[Path]:
+    print(f"Generating pages for {repo} ...")
+
+    owner_path, owner_index_path = create_owner_dir(repo)
+    repo_path = owner_path.joinpath(repo.name)
+    repo_path.mkdir(parents=True, exist_ok=True)
+
+    # numbered from the oldest release, so new releases only touch the last page
+    releases = list(reversed(db.get_releases(repo)))
+    chunks = [releases[i:i + releases_per_page]
+              for i in range(0, len(releases), releases_per_page)]
+
+    pages = [owner_index_path, write_page(repo_path.joinpath("_index.md"),
+                                          generate_repo_index(db, repo, releases_per_page))]
+
+    for i, chunk in enumerate(chunks):
+        pages.append(write_page(repo_path.joinpath(f"{get_release_page_name(i)}.md"),
+                                generate_release_page(db, repo, list(reversed(chunk)))))
+
+    return pages
+
+
+def get_release_page_name(index: int) -> str:
+    return f"releases-{index + 1}"
+
+
+def generate_repo_index(db: Database, repo: GitHubRepo, releases_per_page: int) -> str:
+    summaries = db.get_release_summaries(repo)
+
+    if len(summaries) == 0:
+        table = md.generate_hint("warning", "This repository contains no releases.")
+    else:
+        table = md.generate_table(
+            ["Release", "Date", "Author", "Downloads"],
+            [[f"[{summary['name']}]({get_release_page_name((len(summaries) - 1 - i) // releases_per_page)}/)",
+              datetime.fromisoformat(summary["created_at"]).date().isoformat(),
+              summary["author"], summary["downloads"]]
+             for i, summary in enumerate(summaries)])
+
+    content = inspect.cleandoc(f"""
++++
+title = \"{repo.name}\"
+bookCollapseSection = true
++++
+
+# {repo.name}
+{md.generate_repo_badges(repo)}
+
+## Views
+{generate_view_chart(db, repo)}
+
+## Releases
+""")
+
+    return f"{content}\n{table}"
+
+
+def generate_release_page(db: Database, repo: GitHubRepo, releases: list[sqlite3.Row]) -> str:
+    title = releases[0]["name"] if len(releases) == 1 \
+        else f"{releases[-1]['name']} – {releases[0]['name']}"
+    title = title.replace("\\", "\\\\").replace("\"", "\\\"")
+
+    content = inspect.cleandoc(f"""
++++
+title = \"{title}\"
+date = \"{releases[0]["created_at"]}\"
++++
+
+# {repo.name}
 """)
 
-    with open(owner_path.joinpath(f"{repo.name}.md"), "w") as file:
-        file.write(content)
+    return f"{content}\n{generate_release_charts(db, releases)}"
 
 
 def generate_view_chart(db: Database, repo: GitHubRepo) -> str:
@@ -95,9 +264,7 @@ def generate_view_chart(db: Database, repo: GitHubRepo) -> str:
                                    "Unique": md.make_db_list_str(views, "uniques", False)})
 
 
-def generate_release_charts(db: Database, repo: GitHubRepo) -> str:
-    releases = db.get_releases(repo)
-
+def generate_release_charts(db: Database, releases: list[sqlite3.Row]) -> str:
     if len(releases) == 0:
         return md.generate_hint("warning", "This repository contains no releases.")
 
@@ -108,7 +275,7 @@ def generate_release_charts(db: Database, repo: GitHubRepo) -> str:
 
         assets = db.get_assets(release["id"])
 
-        charts += md.generate_tabs({
+        charts += md.generate_tabs(f"release-{release['id']}", {
             "Over Time": generate_release_line_chart(db, assets),
             "Total": generate_release_bar_chart(db, release["id"], assets)
         })
@@ -154,22 +321,148 @@ def make_gh_connector() -> GitHubConnector:
     return GitHubConnector(gh_token)
 
 
-def fetch_data(db: Database, gh: GitHubConnector, repos: list[GitHubRepo]):
+def fetch_data(db: Database, gh: GitHubConnector, repos: list[GitHubRepo], delta: bool, ignore_journal: bool):
     today = get_current_day().isoformat()
+    week_start = get_start_of_week().isoformat()
+
+    db.clear_journal(today)
+    finished = set() if ignore_journal else db.get_finished_phases(today)
+
+    release_repos = [repo for repo in repos
+                     if (repo.db_id, PHASE_RELEASES) not in finished]
+    view_repos = [repo for repo in repos
+                  if (repo.db_id, PHASE_VIEWS) not in finished]
+
+    if len(release_repos) == 0 and len(view_repos) == 0:
+        print("All repositories have already been fetched today.")
+        return
+
+    # read before the writer thread starts using the connection
+    stored_releases = {repo: db.get_release_creation_dates(repo)
+                       for repo in release_repos} if delta else {}
+
+    with WritePipeline(db) as pipeline:
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            futures = [executor.submit(
+                fetch_releases, gh, pipeline, release_repos, stored_releases, delta, today)]
+            futures += [executor.submit(fetch_views, gh, pipeline, repo, today, week_start)
+                        for repo in view_repos]
+
+            for future in futures:
+                future.result()
+
+
+def fetch_releases(gh: GitHubConnector, pipeline: WritePipeline, repos: list[GitHubRepo],
+                   stored_releases: dict, delta: bool, day: str):
+    if len(repos) == 0:
+        return
+
+    try:
+        if delta:
+            releases, download_counts = fetch_releases_delta(gh, repos, stored_releases)
+        else:
+            releases, download_counts = gh.get_releases(repos), {}
+
+    except requests.RequestException as e:
+        print(e)
+        releases, download_counts = {}, {}
+
+    for repo in repos:
+        if repo not in releases:
+            pipeline.put(partial(write_failure, repo=repo,
+                         day=day, phase=PHASE_RELEASES))
+            continue
+
+        pipeline.put(partial(write_releases, repo=repo, releases=releases[repo],
+                             download_counts=download_counts.get(repo, []), day=day))
+
 
-    releases = gh.get_releases(repos)
+def fetch_releases_delta(gh: GitHubConnector, repos: list[GitHubRepo], stored_releases: dict) -> tuple[dict, dict]:
+    counts = gh.get_release_download_counts(repos)
 
-    for repo in releases:
-        for release in releases[repo]:
-            db.add_release(repo, release, today)
+    new_releases = {}
+    known_releases = {}
 
+    # releases can be published long after their creation (e.g. drafts), so
+    # anything not stored yet is new, regardless of its creation date
+    for repo in counts:
+        new_releases[repo] = {release["createdAt"] for release in counts[repo]
+                              if release["createdAt"] not in stored_releases[repo]}
+        known_releases[repo] = [release for release in counts[repo]
+                                if release["createdAt"] in stored_releases[repo]]
+
+    # the lean result is ordered like the full query, so the first N releases
+    # reach down to the oldest new one
+    releases = gh.get_newest_releases(
+        {repo: max(i for i, release in enumerate(counts[repo]) if release["createdAt"] in new_releases[repo]) + 1
+         for repo in new_releases if len(new_releases[repo]) > 0})
+
+    incomplete = [repo for repo in new_releases if len(new_releases[repo]) > 0 and
+                  (repo not in releases or
+                   not new_releases[repo] <= {release["createdAt"] for release in releases[repo]})]
+
+    if len(incomplete) > 0:
+        print("New releases changed while fetching, fetching all releases for:",
+              ", ".join(map(str, incomplete)))
+        fallback = gh.get_releases(incomplete)
+
+        # repos that failed here are left out and count as failed
+        for repo in incomplete:
+            releases.pop(repo, None)
+            known_releases.pop(repo, None)
+
+            if repo in fallback:
+                releases[repo] = fallback[repo]
+
+    return {repo: releases.get(repo, []) for repo in counts
+            if repo in releases or len(new_releases[repo]) == 0}, known_releases
+
+
+def write_releases(db: Database, repo: GitHubRepo, releases: list[dict], download_counts: list[dict], day: str):
+    for release in releases:
+        db.add_release(repo, release, day, commit=False)
+
+    for release in download_counts:
+        db.add_download_counts(repo, release, day, commit=False)
+
+    write_success(db, repo, day, PHASE_RELEASES)
+
+
+def fetch_views(gh: GitHubConnector, pipeline: WritePipeline, repo: GitHubRepo, day: str, week_start: str):
+    try:
         views = gh.get_views(repo)
 
-        for data in views:
-            db.add_views(repo, data)
+    except requests.RequestException as e:
+        print(e)
+        views = None
+
+    if views == None:
+        pipeline.put(partial(write_failure, repo=repo,
+                     day=day, phase=PHASE_VIEWS))
+        return
+
+    pipeline.put(partial(write_views, repo=repo, views=views,
+                 day=day, week_start=week_start))
+
 
-        if len(views) == 0:
-            db.add_views_zero(repo, get_start_of_week().isoformat())
+def write_views(db: Database, repo: GitHubRepo, views: list[dict], day: str, week_start: str):
+    for data in views:
+        db.add_views(repo, data, commit=False)
+
+    if len(views) == 0:
+        db.add_views_zero(repo, week_start, commit=False)
+
+    write_success(db, repo, day, PHASE_VIEWS)
+
+
+def write_success(db: Database, repo: GitHubRepo, day: str, phase: str):
+    db.set_journal_status(repo, day, phase, STATUS_DONE, commit=False)
+    db.set_last_fetched(repo, day, [PHASE_RELEASES, PHASE_VIEWS], commit=False)
+
+
+def write_failure(db: Database, repo: GitHubRepo, day: str, phase: str):
+    print(f"Failed to fetch {phase} for {repo}.")
+    db.set_journal_status(repo, day, phase, STATUS_FAILED, commit=False)
 
 
 def get_from_args_or_env(args_value: list[str], env_key: str) -> list[str]:
@@ -184,6 +477,40 @@ def get_from_args_or_env(args_value: list[str], env_key: str) -> list[str]:
     return [value.strip() for value in values.split(",")]
 
 
+def get_int_from_args_or_env(args_value: int | None, env_key: str) -> int | None:
+    if args_value != None:
+        return args_value
+
+    value = os.getenv(env_key)
+
+    if not value or len(value) == 0:
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{env_key} is not an integer: {value}")
+
+
+def get_retention_settings(parser: argparse.ArgumentParser, args: argparse.Namespace) -> tuple[int | None, int | None, int]:
+    try:
+        daily = get_int_from_args_or_env(args.retention_daily, "RW_RETENTION_DAILY")
+        weekly = get_int_from_args_or_env(args.retention_weekly, "RW_RETENTION_WEEKLY")
+        vacuum_pages = get_int_from_args_or_env(args.vacuum_pages, "RW_VACUUM_PAGES")
+    except ValueError as e:
+        parser.error(str(e))
+
+    # values from the environment bypass the argparse type checks
+    for value in [daily, weekly, vacuum_pages]:
+        if value != None and value <= 0:
+            parser.error("retention periods and vacuum pages must be positive")
+
+    if weekly != None and (daily == None or weekly <= daily):
+        parser.error("the weekly retention period must be longer than the daily one")
+
+    return daily, weekly, vacuum_pages if vacuum_pages != None else VACUUM_PAGES
+
+
 def get_repos(args: argparse.Namespace, gh: GitHubConnector) -> list[GitHubRepo]:
     users = get_from_args_or_env(args.users, "RW_USERS")
     orgs = get_from_args_or_env(args.orgs, "RW_ORGS")
@@ -206,13 +533,39 @@ def get_repos(args: argparse.Namespace, gh: GitHubConnector) -> list[GitHubRepo]
     return repos
 
 
+def import_snapshots(args: argparse.Namespace):
+    print("Importing snapshots ...")
+
+    with Database() as db:
+        if not db.connect(SQLITE_FILENAME):
+            exit(1)
+
+        db.update_tables()
+
+        importer = SnapshotImporter(db, args.batch_size)
+
+        for file in args.files:
+            importer.import_file(file)
+
+        print(f"Imported {importer.rows} rows ({importer.rows_per_second:.0f} rows/sec).")
+
+    print("Done.")
+
+
 def main():
     parser = init_argparse()
     args = parser.parse_args()
 
+    if args.command == "import":
+        import_snapshots(args)
+        return
+
     print("Updating statistics ...")
     load_dotenv()
 
+    retention_daily, retention_weekly, vacuum_pages = get_retention_settings(
+        parser, args)
+
     gh = make_gh_connector()
     repos = get_repos(args, gh)
 
@@ -225,12 +578,14 @@ def main():
         db.set_repo_ids(repos)
 
         if not args.generate_only:
-            fetch_data(db, gh, repos)
+            fetch_data(db, gh, repos, args.delta, args.ignore_journal)
 
         db.optimize()
+        db.apply_retention(retention_daily, retention_weekly)
+        db.incremental_vacuum(vacuum_pages)
 
         if not args.fetch_only:
-            generate_all_pages(db, repos)
+            generate_all_pages(db, repos, args.layout, args.releases_per_page)
 
     print("Done.")
 